@@ -1,15 +1,25 @@
 import streamlit as st
 import pandas as pd
-import yfinance as yf
 import requests
+from requests.adapters import HTTPAdapter
 import numpy as np
-import re
+import numba
 import time
+import math
+import hashlib
+import asyncio
+import aiohttp
 from datetime import datetime, timedelta
 import urllib3
+from urllib3.util.retry import Retry
+from diskcache import Cache
+
+# TPEx 憑證鏈在部分環境驗證失敗，預設不驗證；改為 True 即恢復驗證與警告
+VERIFY_SSL = False
 
 # 關閉 SSL 警告
-urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+if not VERIFY_SSL:
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
 # --- Configuration ---
 st.set_page_config(
@@ -18,6 +28,38 @@ st.set_page_config(
     layout="wide"
 )
 
+# 同時下載的連線數 (K 線下載為 I/O-bound)
+MAX_WORKERS = 10
+
+# 磁碟快取：Streamlit 重啟後仍保留已下載的 K 線
+# K 線只放這一層，不再疊 st.cache_data，避免重啟後的磁碟命中又在記憶體多留一輪 ttl
+_DISK_CACHE = Cache("./yf_cache")
+KLINE_TTL = 600
+
+# 股票代碼只保留數字：str.translate 比逐格 re.sub 快
+# 轉換表遇到沒看過的字元才判斷 (非十進位數字 -> 刪除)，涵蓋所有 Unicode，等同 \D
+class _DigitsOnly(dict):
+    def __missing__(self, key):
+        value = key if chr(key).isdecimal() else None
+        self[key] = value
+        return value
+
+_DIGITS_ONLY = _DigitsOnly()
+
+# 暫時性錯誤 (限流 / 伺服器錯誤 / 逾時) 的重試次數與退避，requests 與 aiohttp 兩條路徑共用
+RETRY_TOTAL = 3
+RETRY_BACKOFF = 0.3
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# 共用連線：keep-alive 重用 TCP/TLS，並對暫時性錯誤自動重試
+_SESSION = requests.Session()
+_SESSION.headers.update({"User-Agent": "Mozilla/5.0"})
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=10,
+    pool_maxsize=MAX_WORKERS,
+    max_retries=Retry(total=RETRY_TOTAL, backoff_factor=RETRY_BACKOFF, status_forcelist=RETRY_STATUS),
+))
+
 # ==========================================
 # PART 1: 資料抓取核心
 # ==========================================
@@ -32,7 +74,6 @@ def get_tpex_top_buys(input_date):
     
     API = "https://www.tpex.org.tw/www/zh-tw/insti/sitcStat"
     HEADERS = {
-        "User-Agent": "Mozilla/5.0",
         "Referer": "https://www.tpex.org.tw/zh-tw/mainboard/trading/major-institutional/domestic-inst/day.html"
     }
     
@@ -44,17 +85,26 @@ def get_tpex_top_buys(input_date):
         "response": "json"
     }
 
+    # 優化 10: 原始 JSON 存到磁碟快取，重啟後同一天重新篩選不必再打 TPEx
+    cache_key = ("tpex_sitc_buy", date_str)
+
     try:
-        r = requests.get(API, params=params, headers=HEADERS, timeout=10, verify=False)
-        r.raise_for_status()
-        data = r.json()
+        data = _DISK_CACHE.get(cache_key)
+        if data is None:
+            r = _SESSION.get(API, params=params, headers=HEADERS, timeout=10, verify=VERIFY_SSL)
+            r.raise_for_status()
+            data = r.json()
+            # 只存有資料的回應，避免尚未公布時的空結果被留住 4 小時
+            tables = data.get("tables") or []
+            if tables and tables[0].get("data"):
+                _DISK_CACHE.set(cache_key, data, expire=3600*4)
         
         if "tables" in data and len(data["tables"]) > 0:
             raw_data = data["tables"][0]["data"]
             results = []
             for row in raw_data:
                 try:
-                    code = re.sub(r"\D", "", str(row[1] or ""))
+                    code = str(row[1] or "").translate(_DIGITS_ONLY)
                     name = row[2]
                     net_buy = int(str(row[5]).replace(',', ''))
                     
@@ -78,72 +128,232 @@ def get_tpex_top_buys(input_date):
 # PART 2: K線與趨勢分析 (優化版)
 # ==========================================
 
-# 優化 1: 加入快取，調整參數改變時不用重新下載
-@st.cache_data(ttl=600) 
-def fetch_5m(code, days=5):
+def _to_taipei(df):
+    # 時區處理
+    if df.index.tz is None:
+        df.index = df.index.tz_localize("UTC").tz_convert("Asia/Taipei")
+    else:
+        df.index = df.index.tz_convert("Asia/Taipei")
+    return df
+
+CHART_API = "https://query1.finance.yahoo.com/v8/finance/chart/{symbol}"
+
+# 櫃買盤中 09:00-13:30，每個交易日 54 根 5分K；Yahoo 5分K 最多只給 60 天
+# 冷門股沒成交的 K 棒會被濾掉，至少抓 10 天 (原本的固定值) 保留缺 K 棒的餘裕
+BARS_PER_SESSION = 54
+MIN_5M_DAYS = 10
+MAX_5M_DAYS = 60
+
+def days_for_window(window):
+    """window 根 5分K 需要下載幾個交易日 (多抓 1 天補盤中尚未收完的當日)"""
+    return min(MAX_5M_DAYS, max(MIN_5M_DAYS, math.ceil(window / BARS_PER_SESSION) + 1))
+
+def _chart_to_df(payload):
+    """Yahoo chart API 的 JSON -> 收盤價 DataFrame"""
+    result = (payload.get("chart") or {}).get("result") or []
+    if not result or not result[0].get("timestamp"): return pd.DataFrame()
+    
+    ts = result[0]["timestamp"]
+    q = result[0]["indicators"]["quote"][0]
+    # 趨勢判斷與走勢圖只用到 Close，其餘欄位不保留 (快取也跟著變小)
+    # 股價用 float32 (約 7 位有效數字) 已足夠，快取記憶體再減半
+    df = pd.DataFrame(
+        {"Close": q.get("close")},
+        index=pd.to_datetime(ts, unit="s", utc=True)
+    ).dropna().astype(np.float32)
+    
+    return _to_taipei(df)
+
+async def _get_chart_json(session, url, params):
+    """
+    回傳 chart API 的 JSON；查無代碼 (404 等) 回傳 {}
+    限流 / 伺服器錯誤 / 逾時以指數退避重試，次數用完仍失敗就丟出例外
+    """
+    for attempt in range(RETRY_TOTAL + 1):
+        try:
+            async with session.get(url, params=params) as r:
+                if r.status == 200: return await r.json()
+                if r.status not in RETRY_STATUS: return {}
+                error = f"HTTP {r.status}"
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            error = repr(e)
+        if attempt < RETRY_TOTAL:
+            await asyncio.sleep(RETRY_BACKOFF * 2 ** attempt)
+    raise RuntimeError(f"{url}: {error}")
+
+async def fetch_5m_async(session, code, days=5):
+    """回傳 df；Yahoo 查無資料為空 df，重試後仍連線失敗則回傳 None"""
     if not code: return pd.DataFrame()
-    for suf in (".TWO", ".TW"):  
+    failed = False
+    for suf in (".TWO", ".TW"):
+        url = CHART_API.format(symbol=f"{code}{suf}")
+        params = {"interval": "5m", "range": f"{days}d", "includePrePost": "false"}
         try:
-            ticker = f"{code}{suf}"
-            # 抓取資料
-            df = yf.Ticker(ticker).history(
-                period=f"{days}d", interval="5m", auto_adjust=False, prepost=False
-            )
-            if df is None or df.empty: continue
-            
-            df = df.rename(columns=str.title)[["Open", "High", "Low", "Close", "Volume"]].copy()
-            
-            # 時區處理
-            if df.index.tz is None:
-                df.index = df.index.tz_localize("UTC").tz_convert("Asia/Taipei")
-            else:
-                df.index = df.index.tz_convert("Asia/Taipei")
-            
-            return df
-        except Exception:
+            df = _chart_to_df(await _get_chart_json(session, url, params))
+        except Exception as e:
+            print(f"Error fetching 5m data: {e}")
+            failed = True
             continue
-    return pd.DataFrame()
+        if df.empty: continue
+        
+        return df
+    return None if failed else pd.DataFrame()
 
-def judge_trend_300(df, window=300, r2_thresh=0.10, strength_abs=0.01):
-    if df.empty: return "N/A", 0, 0, 0, []
+async def _gather_5m(codes, days):
+    # Semaphore 控制同時連線數，避免被 Yahoo 限流
+    sem = asyncio.Semaphore(MAX_WORKERS)
+    timeout = aiohttp.ClientTimeout(total=10)
+    async with aiohttp.ClientSession(headers={"User-Agent": "Mozilla/5.0"}, timeout=timeout) as session:
+        async def bounded(code):
+            async with sem:
+                return await fetch_5m_async(session, code, days)
+        return await asyncio.gather(*(bounded(code) for code in codes))
 
-    # 取最後 window 根 K 棒
-    d = df.tail(window).dropna(subset=["Close"])
-    n = len(d)
-    last = float(d["Close"].iloc[-1])
-    sma = float(d["Close"].mean()) if n else 0
-    
-    # 優化 2: 準備給 Sparkline 用的數據 (標準化，避免圖形跑掉)
-    # 取最後 50 根 K 棒畫圖就好，不然圖會太密
-    sparkline_data = d["Close"].tail(50).tolist()
+# 優化 1: 加入快取，調整參數改變時不用重新下載
+# 以 (code, days) 逐檔快取，增加顯示檔數時只下載新加入的那幾檔
+# 優化 4: 快取沒命中的才用 asyncio 併發下載，總耗時約 RTT；這裡是同步呼叫的轉接
+def fetch_5m_many(codes, days=5):
+    """
+    回傳 ({code: df}, 下載失敗的代碼 list)
+    空資料 (查無或下載失敗) 不寫入快取，下次重新下載
+    """
+    frames = {}
+    misses = []
+    for code in dict.fromkeys(c for c in codes if c):
+        df = _DISK_CACHE.get(("fetch_5m", code, days))
+        if df is None: misses.append(code)
+        else: frames[code] = df
 
-    if n < max(60, int(window * 0.6)):
-        return "資料不足", last, sma, 0, sparkline_data
+    failed = []
+    if misses:
+        for code, df in zip(misses, asyncio.run(_gather_5m(misses, days))):
+            if df is None:
+                failed.append(code)
+                df = pd.DataFrame()
+            elif not df.empty:
+                _DISK_CACHE.set(("fetch_5m", code, days), df, expire=KLINE_TTL)
+            frames[code] = df
+    return frames, failed
 
-    # --- 線性迴歸核心 (您的 R2 邏輯) ---
-    x = np.arange(n, dtype=float)
-    y = d["Close"].astype(float).values
-    slope, b = np.polyfit(x, y, 1)
+# 優化 8: 一次迴歸用 numba JIT 封閉解，取代 np.polyfit (內部走 SVD，殺雞用牛刀)
+# 優化 9: 融合成單次走訪累加，不產生 x / yhat / 殘差等中間陣列
+@numba.njit(cache=True, fastmath=True)
+def _trend_core(y, window):
+    """回傳 (斜率, 均價, R2, 強度)"""
+    n = len(y)
+    # x = 0..n-1 為等距整數，均值與離差平方和都有封閉解，不必建設計矩陣或走 lstsq
+    mx = (n - 1) / 2.0
+    sxx = n * (n * n - 1) / 12.0
+    
+    # Σ(x - mx) = 0，所以 sxy = Σ(x - mx)·y，可與均值同一趟累加
+    my = 0.0
+    sxy = 0.0
+    for i in range(n):
+        my += y[i]
+        sxy += (i - mx) * y[i]
+    my /= n
+    slope = sxy / sxx
+    
+    ss_tot = 0.0                                   # 總變異
+    for i in range(n):
+        dy = y[i] - my
+        ss_tot += dy * dy
     
     # 計算 R2 (決定係數): 衡量趨勢的穩定度
-    yhat = slope * x + b
-    ss_res = float(np.sum((y - yhat)**2))         # 殘差平方和
-    ss_tot = float(np.sum((y - y.mean())**2))     # 總變異
-    r2 = 0.0 if ss_tot == 0 else (1 - ss_res / ss_tot)
+    # 一次迴歸的 R2 = sxy² / (sxx · ss_tot)，等價於 1 - 殘差平方和 / 總變異
+    r2 = 0.0 if ss_tot == 0 else sxy * sxy / (sxx * ss_tot)
     
     # 計算強度 (Strength): 斜率 * 期間 / 均價
     # 意義：這段期間內，股價總共漲/跌了百分之多少
-    strength = float(slope * window / y.mean())
+    strength = slope * window / my
+    return slope, my, r2, strength
+
+# 優化 14: 所有個股堆成 (檔數 × window) 矩陣，一次丟進 prange 平行 kernel，取代逐檔呼叫
+# 各列長度不同，右側補 0，以 lens 標示實際 K 棒數；輸入為 float32，累加一律用 float64
+@numba.njit(parallel=True, fastmath=True, cache=True)
+def _trend_batch(Y, lens, window):
+    """回傳 (斜率, 均價, R2, 強度) 四個長度為檔數的陣列"""
+    T = Y.shape[0]
+    slope = np.empty(T)
+    mean = np.empty(T)
+    r2 = np.empty(T)
+    strength = np.empty(T)
+    for t in numba.prange(T):
+        s, m, r, k = _trend_core(Y[t, :lens[t]], window)
+        slope[t] = s
+        mean[t] = m
+        r2[t] = r
+        strength[t] = k
+    return slope, mean, r2, strength
+
+# 優化 11: 迴歸只跟收盤價與 window 有關，跟門檻無關，調整門檻重新掃描時不必重算
+# 快取 key 是輸入矩陣內容的雜湊 (_Y / _lens 本身不參與雜湊)，K 線一變 key 就跟著變
+# 只快取三個數值陣列，命中時不必反序列化 sparkline
+@st.cache_data(max_entries=32)
+def _trend_regression(digest, window, _Y, _lens):
+    """回傳 (均價, R2, 強度) 三個長度為檔數的陣列"""
+    _, mean, r2, strength = _trend_batch(_Y, _lens, window)
+    return mean, r2, strength
+
+def trend_stats_300(codes, window, frames):
+    """
+    回傳與 codes 同順序的 [(狀態, 現價, 均價, 強度, R2, sparkline), ...]
+    狀態為 None 代表資料足夠
+    """
+    window = int(window)
+    min_n = max(60, int(window * 0.6))
+
+    # 取最後 window 根 K 棒
+    # 優化 7: 只轉一次 NumPy，之後都用陣列切片，避免重複的 pandas 索引開銷
+    closes = []
+    for code in codes:
+        df = frames.get(code)
+        if df is None or df.empty:
+            closes.append(np.empty(0, dtype=np.float32))
+        else:
+            closes.append(df["Close"].tail(window).dropna().to_numpy(dtype=np.float32))
+
+    # --- 線性迴歸核心 (您的 R2 邏輯) ---
+    ok = [i for i, y in enumerate(closes) if len(y) >= min_n]
+    Y = np.zeros((len(ok), window), dtype=np.float32)
+    lens = np.array([len(closes[i]) for i in ok], dtype=np.int64)
+    for row, i in enumerate(ok):
+        Y[row, :lens[row]] = closes[i]
+    digest = hashlib.blake2b(Y.tobytes() + lens.tobytes(), digest_size=16).hexdigest()
+    mean, r2, strength = _trend_regression(digest, window, Y, lens)
+    rows = {i: row for row, i in enumerate(ok)}
+
+    stats = []
+    for i, y in enumerate(closes):
+        if len(y) == 0:
+            stats.append(("N/A", 0, 0, 0, 0, []))
+            continue
+        last = float(y[-1])
+        
+        # 優化 2: 準備給 Sparkline 用的數據 (標準化，避免圖形跑掉)
+        # 取最後 50 根 K 棒畫圖就好，不然圖會太密
+        sparkline_data = y[-50:].tolist()
+
+        if i not in rows:
+            stats.append(("資料不足", last, float(y.mean(dtype=np.float64)), 0, 0, sparkline_data))
+        else:
+            # 均價直接用 kernel 算強度時的同一個 float64 均值，判斷 last > sma 才一致
+            row = rows[i]
+            stats.append((None, last, float(mean[row]), float(strength[row]), float(r2[row]), sparkline_data))
+    return stats
+
+def judge_trend_300(stats, r2_thresh=0.10, strength_abs=0.01):
+    status, last, sma, strength, r2, sparkline_data = stats
+    if status is not None: return status, last, sma, strength, r2, sparkline_data
 
     # 判斷邏輯
-    up_ok   = (strength >=  strength_abs) and (last > y.mean()) and (r2 >= r2_thresh)
-    down_ok = (strength <= -strength_abs) and (last < y.mean()) and (r2 >= r2_thresh)
-    
+    # 優化 12: R2 門檻兩個方向共用，先判斷；沒過就直接是盤整，不必再比強度與均價
     direction = "➡️ 盤整"
-    if up_ok: direction = "🔥 上升"
-    elif down_ok: direction = "📉 下降"
+    if r2 >= r2_thresh:
+        if (strength >= strength_abs) and (last > sma): direction = "🔥 上升"
+        elif (strength <= -strength_abs) and (last < sma): direction = "📉 下降"
 
-    return direction, last, sma, strength, sparkline_data
+    return direction, last, sma, strength, r2, sparkline_data
 
 # ==========================================
 # PART 3: Streamlit UI
@@ -155,7 +365,7 @@ selected_date = st.sidebar.date_input("選擇日期", value=today, max_value=tod
 
 st.sidebar.subheader("篩選條件")
 top_n = st.sidebar.slider("顯示前幾名買超", 5, 50, 20)
-window_size = st.sidebar.number_input("趨勢判斷 K 棒數", value=300, help="300根5分K約等於5-6個交易日")
+window_size = st.sidebar.number_input("趨勢判斷 K 棒數", min_value=1, value=300, help="300根5分K約等於5-6個交易日")
 
 col1, col2 = st.sidebar.columns(2)
 with col1:
@@ -178,37 +388,38 @@ if st.button("開始掃描", type="primary"):
     else:
         status_text.success(f"✅ 成功取得 {date_str} 買超排行！")
         
-        targets = df_buys.head(top_n).to_dict('records')
+        targets = df_buys.head(top_n)
         st.info(f"正在分析前 {len(targets)} 檔股票的 5分K 趨勢...")
         
-        final_results = []
-        progress_bar = st.progress(0)
+        codes = targets["code"].tolist()
+        # 依 K 棒數換算交易日數，K 棒數大時不再被固定的 10 天卡住
+        days = days_for_window(window_size)
+        
+        # 直接打 chart API 併發下載，不經 yfinance 物件層
+        with st.spinner("下載 5分K 中..."):
+            frames, failed = fetch_5m_many(codes, days=days)
+        if failed:
+            st.warning(f"⚠️ {len(failed)} 檔 5分K 下載失敗 (可能被 Yahoo 限流)，請稍後再掃描：{', '.join(failed)}")
         
-        for i, stock in enumerate(targets):
-            progress_bar.progress((i + 1) / len(targets))
-            code = stock['code']
-            
-            df_k = fetch_5m(code, days=10)
-            
-            # 加入 sparkline_data 回傳
-            direction, last, sma, strength, sparkline = judge_trend_300(
-                df_k, window=window_size, r2_thresh=r2_th, strength_abs=strength_th
-            )
-            
-            final_results.append({
-                "代碼": code,
-                "名稱": stock['name'],
-                "買超張數": int(stock['net']),
-                "現價": round(last, 2) if last else 0,
-                "趨勢方向": direction,
-                "強度": round(strength, 4) if strength else 0,
-                "R2穩定度": 0, # 這裡原本沒回傳R2，如果您需要看R2數值，judge_trend_300 需修改回傳 r2
-                "走勢預覽": sparkline # 給 LineChartColumn 用
-            })
-            
-        progress_bar.empty()
+        # 加入 sparkline_data 回傳
+        trends = [
+            judge_trend_300(stats, r2_thresh=r2_th, strength_abs=strength_th)
+            for stats in trend_stats_300(codes, window_size, frames)
+        ]
+        directions, lasts, _, strengths, r2s, sparklines = zip(*trends)
         
-        res_df = pd.DataFrame(final_results)
+        # 優化 13: 直接以欄為單位組表，不再逐列 append dict 再轉 DataFrame
+        # 數值欄存原始 float，小數位交給 column_config 顯示，表格排序才會照數值
+        res_df = pd.DataFrame({
+            "代碼": codes,
+            "名稱": targets["name"].to_numpy(),
+            "買超張數": targets["net"].to_numpy(dtype=int),
+            "現價": np.asarray(lasts, dtype=float),
+            "趨勢方向": list(directions),
+            "強度": np.asarray(strengths, dtype=float),
+            "R2穩定度": np.asarray(r2s, dtype=float),
+            "走勢預覽": list(sparklines) # 給 LineChartColumn 用
+        })
         
         # --- 優化顯示設定 ---
         st.write(f"### 📊 買超趨勢 ({date_str})")
@@ -232,6 +443,11 @@ if st.button("開始掃描", type="primary"):
                     max_value=0.1,
                     help="紅色代表強勢上漲，藍色代表下跌"
                 ),
+                "R2穩定度": st.column_config.NumberColumn(
+                    "R2 穩定度",
+                    format="%.2f",
+                    help="越接近 1 代表走勢越貼近直線"
+                ),
                 # 優化 3: 加入走勢圖 Sparkline
                 "走勢預覽": st.column_config.LineChartColumn(
                     "近50根K棒走勢",